@@ -26,6 +26,7 @@ stanza.  For example, on an Air/Sky setup:
     udp_port = 50222
     udp_timeout = 90
     share_socket = True
+    udp_rcvbuf = 4194304
 
     [[sensor_map]]
         outTemp = air_temperature.AR-00004424.obs_air
@@ -124,6 +125,24 @@ Options:
     True if you have other apps running on your weewx host listening
     for WF UDP packets.
 
+    udp_rcvbuf = 4194304
+
+    The size in bytes of the kernel receive buffer requested for
+    the UDP socket.  A bigger buffer keeps packets that arrive in
+    a burst from being dropped while weewx is busy doing something
+    else.  The operating system may cap the request (on Linux, see
+    net.core.rmem_max), so the requested size and the size that the
+    kernel reports back are both logged at startup.  Note that Linux
+    reports twice the usable size, because it counts its own
+    bookkeeping overhead: a 4194304 request that was granted in full
+    shows up as 8388608.  Set it to 0 to leave the operating system
+    default alone.
+
+The driver decodes packets with the orjson Python package
+if it is installed (e.g. pip install orjson), since it is
+faster than Python's standard json module.  It is optional:
+without it, the standard json module is used.
+
 Finally, let me add a thank you to Matthew Wall for the
 sensor map naming logic that I borrowed from his weewx-SDR
 station driver code: 
@@ -141,17 +160,38 @@ for a Nobel Prize or something...
 """
 
 from __future__ import with_statement
-import json
+import errno
+import select
 import time
 
 import sys
 from socket import *
 
+try:
+    from sys import intern
+except ImportError:
+    # Python 2 has intern() as a builtin, but it only takes byte strings and JSON gives us unicode
+    _intern = intern
+
+    def intern(s):
+        return _intern(s) if isinstance(s, str) else s
+
 import weewx.units
 import weewx.drivers
 import weewx.wxformulas
 from weeutil.weeutil import tobool
 
+try:
+    # orjson is considerably faster, and decodes bytes without a str round-trip. It can also
+    # read straight out of the receive buffer.
+    import orjson as _json
+    _loads_buffer = _json.loads
+except ImportError:
+    import json as _json
+
+    def _loads_buffer(view):
+        return _json.loads(view.tobytes())
+
 # Default settings...
 DRIVER_VERSION = "1.11"
 HARDWARE_NAME = "WeatherFlow"
@@ -176,6 +216,11 @@ try:
     def logerr(msg):
         log.error(msg)
 
+
+    def lograw(pkt):
+        # Let logging do the formatting, so that it only happens if the record gets emitted
+        log.info('raw packet: %s', pkt)
+
 except ImportError:
     # Old-style weewx logging
     import syslog
@@ -197,6 +242,13 @@ except ImportError:
         logmsg(syslog.LOG_ERR, msg)
 
 
+    def lograw(pkt):
+        # setlogmask(0) reports the current mask without changing it, so skip formatting the
+        # packet when INFO is masked out
+        if syslog.setlogmask(0) & syslog.LOG_MASK(syslog.LOG_INFO):
+            loginf('raw packet: %s' % pkt)
+
+
 # Observation record fields...
 fields = dict()
 fields['obs_air'] = ('time_epoch', 'station_pressure', 'air_temperature', 'relative_humidity', 'lightning_strike_count', 'lightning_strike_avg_distance', 'battery', 'report_interval')
@@ -206,59 +258,122 @@ fields['evt_precip'] = ('time_epoch',)
 fields['evt_strike'] = ('time_epoch', 'distance', 'energy')
 fields['obs_st'] = ('time_epoch', 'wind_lull', 'wind_avg', 'wind_gust', 'wind_direction', 'wind_sample_interval', 'station_pressure', 'air_temperature', 'relative_humidity', 'illuminance', 'uv', 'solar_radiation', 'rain_accumulated', 'precipitation_type', 'lightning_strike_avg_distance', 'lightning_strike_count', 'battery', 'report_interval')
 
+# Intern the names, since every parsed packet uses them to build its keys
+fields = dict((pkt_type, tuple(intern(key) for key in names)) for pkt_type, names in fields.items())
+
+# Where each observation-bearing packet type keeps its values: the payload
+# key, whether the values are nested one list deeper (obs is a list of
+# observations, ob and evt are a single flat list), and the field names,
+# so that a single lookup is all parseUDPPacket needs.
+_PAYLOAD = {
+    'obs_air': ('obs', True, fields['obs_air']),
+    'obs_sky': ('obs', True, fields['obs_sky']),
+    'obs_st': ('obs', True, fields['obs_st']),
+    'rapid_wind': ('ob', False, fields['rapid_wind']),
+    'evt_strike': ('evt', False, fields['evt_strike']),
+    'evt_precip': ('evt', False, fields['evt_precip']),
+}
+
+# Packet types with no payload list, whose timestamp is in the 'timestamp' field
+_STATUS_TYPES = frozenset(('device_status', 'hub_status'))
+
+def _normalize(s):
+    """Return s with dashes replaced by underscores, as used in packet labels.
+
+    The result is interned, so that sensor_map labels and parsed packet keys
+    end up as the same string objects. Only call this on sensor_map labels and
+    on serial numbers that the sensor_map refers to: interning whatever
+    arrives on the network would grow without bound."""
+    # str.replace() beats str.translate() by a wide margin for a single character swap,
+    # and it behaves the same on Python 2 byte strings and unicode.
+    return intern(s.replace("-","_"))
+
 def loader(config_dict, engine):
     return WeatherFlowUDPDriver(**config_dict[DRIVER_NAME])
 
 
-def sendMyLoopPacket(pkt,sensor_map):
-    packet = dict()
-    if 'time_epoch' in pkt:
-        packet = {
-            'dateTime': pkt['time_epoch'],
-            'usUnits' : weewx.METRICWX
-        }
+def reverseSensorMap(sensor_map):
+    """Invert a sensor_map into {normalized_label: (weewx_field, ...)}.
 
+    The same observation can feed more than one weewx field (e.g. a Tempest
+    battery reading), so each label maps onto a tuple of field names."""
+    rev_map = dict()
     for pkt_weewx, pkt_label in sensor_map.items():
-        if pkt_label.replace("-","_") in pkt:
-           packet[pkt_weewx] = pkt[pkt_label.replace("-","_")]
+        label = _normalize(pkt_label)
+        rev_map[label] = rev_map.get(label, ()) + (pkt_weewx,)
+    return rev_map
 
-    return packet
 
-def parseUDPPacket(pkt):
+def sendMyLoopPacket(pkt,rev_map,map_items=()):
+    # Returns None unless the packet has a timestamp and matches at least one sensor_map entry
+    time_epoch = pkt.get('time_epoch')
+    if time_epoch is None:
+        return None
+
+    packet = {
+        'dateTime': time_epoch,
+        'usUnits' : weewx.METRICWX
+    }
+    hit = False
+
+    # Walk whichever is shorter: the (weewx_field, label) pairs, or the parsed packet
+    if map_items and len(map_items) < len(pkt):
+        for pkt_weewx, pkt_label in map_items:
+            if pkt_label in pkt:
+                packet[pkt_weewx] = pkt[pkt_label]
+                hit = True
+    else:
+        for pkt_label, value in pkt.items():
+            pkt_weewx = rev_map.get(pkt_label)
+            if pkt_weewx is not None:
+                for field in pkt_weewx:
+                    packet[field] = value
+                hit = True
+
+    return packet if hit else None
+
+def parseUDPPacket(pkt, raw_fields=None, key_cache=None, _payload=_PAYLOAD):
+    # Only the raw packet fields named in raw_fields get copied into the result, since most of
+    # them (hub_sn, obs, ...) are never mapped. None copies all of them, for identifying sensors.
+    # key_cache is a dict owned by the caller, which keeps the interned keys for each
+    # (serial_number, type) so that they can be reused for every packet. Only ever pass one along
+    # with packets that the sensor_map refers to. Without it, the keys are built afresh each time.
     packet = dict()
     if 'serial_number' in pkt:
         if 'type' in pkt:
-            serial_number = pkt['serial_number'].replace("-","_")
-            pkt_label = serial_number + "." + pkt['type']
-            for key in pkt:
-                packet[key + "." + pkt_label] = pkt[key]
-
-            if pkt['type'] in ('obs_air', 'obs_sky', 'obs_st'):
-                packet['time_epoch'] = pkt['obs'][0][0]
-                for key, value in zip(fields[pkt['type']], pkt['obs'][0]):
-                    packet[key + "." + pkt_label] = value
-
-            elif pkt['type'] == 'rapid_wind':
-                packet['time_epoch'] = pkt['ob'][0]
-                for key, value in zip(fields['rapid_wind'], pkt['ob']):
-                    packet[key + "." + pkt_label] = value
-
-            elif pkt['type'] in ('evt_strike', 'evt_precip'):
-                packet['time_epoch'] = pkt['evt'][0]
-                for key, value in zip(fields[pkt['type']], pkt['evt']):
-                    packet[key + "." + pkt_label] = value
-
-            elif pkt['type'] == 'device_status':
-                packet['time_epoch'] = pkt['timestamp']
+            pkt_type = pkt['type']
+            payload = _payload.get(pkt_type)
+            names = payload[2] if payload is not None else ()
+            if key_cache is None:
+                suffix = "." + pkt['serial_number'].replace("-","_") + "." + pkt_type
+                keys = tuple(key + suffix for key in names)
+            else:
+                cached = key_cache.get((pkt['serial_number'], pkt_type))
+                if cached is None:
+                    suffix = intern("." + _normalize(pkt['serial_number']) + "." + pkt_type)
+                    cached = key_cache[(pkt['serial_number'], pkt_type)] = \
+                        (suffix, tuple(intern(key + suffix) for key in names))
+                suffix, keys = cached
+
+            if raw_fields is None:
+                packet.update((key + suffix, value) for key, value in pkt.items())
+            else:
+                packet.update((key + suffix, value) for key, value in pkt.items() if key in raw_fields)
+
+            if payload is not None:
+                payload_key, nested, _ = payload
+                data = pkt[payload_key][0] if nested else pkt[payload_key]
+                packet['time_epoch'] = data[0]
+                packet.update(zip(keys, data))
 
-            elif pkt['type'] == 'hub_status':
+            elif pkt_type in _STATUS_TYPES:
                 packet['time_epoch'] = pkt['timestamp']
 
-            elif pkt['type'][0:2] == 'X_':
+            elif pkt_type[0:2] == 'X_':
                 packet['time_epoch'] = int(time.time())
 
             else:
-                logerr("Unknown packet type: '%s'" % pkt['type'])
+                logerr("Unknown packet type: '%s'" % pkt_type)
 
         else:
             loginf('Corrupt UDP packet? %s' % pkt)
@@ -276,7 +391,17 @@ class WeatherFlowUDPDriver(weewx.drivers.AbstractDevice):
         self._udp_port = int(stn_dict.get('udp_port', 50222))
         self._udp_timeout = int(stn_dict.get('udp_timeout', 90))
         self._share_socket = tobool(stn_dict.get('share_socket', False))
+        self._udp_rcvbuf = int(stn_dict.get('udp_rcvbuf', 4 * 1024 * 1024))
         self._sensor_map = stn_dict.get('sensor_map', {})
+        self._sensor_map_rev = reverseSensorMap(self._sensor_map)
+        self._sensor_map_items = tuple((pkt_weewx, _normalize(pkt_label))
+                                       for pkt_weewx, pkt_label in self._sensor_map.items())
+        # The (hardware_id, packet_type) pairs that the sensor_map refers to
+        self._sensor_map_sources = set(tuple(label.split('.')[-2:]) for label in self._sensor_map_rev)
+        # ...and the observation names, which is all that we need to keep from each raw packet
+        self._sensor_map_names = set(label.split('.')[0] for label in self._sensor_map_rev)
+        # The interned suffix and field keys for each mapped (serial_number, type), built on first sight
+        self._key_cache = dict()
         loginf('sensor map is %s' % self._sensor_map)
         loginf('*** Sensor names per packet type')
 
@@ -287,10 +412,30 @@ class WeatherFlowUDPDriver(weewx.drivers.AbstractDevice):
         return HARDWARE_NAME
 
     def genLoopPackets(self):
+        # Bind everything used per packet to locals, to save the attribute and global lookups
+        parse = parseUDPPacket
+        build = sendMyLoopPacket
+        sources = self._sensor_map_sources
+        names = self._sensor_map_names
+        rev_map = self._sensor_map_rev
+        map_items = self._sensor_map_items
+        key_cache = self._key_cache
+
         for udp_packet in self.gen_udp_packets():
-            m2 = parseUDPPacket(udp_packet)
-            m3 = sendMyLoopPacket(m2, self._sensor_map)
-            if len(m3) > 2:
+            # Don't bother parsing packets that cannot contribute to the sensor_map. Packets without a
+            # serial_number or type still go through parseUDPPacket so that they get logged. The
+            # serial number comes off the network, so normalize it without interning or caching anything.
+            if 'serial_number' in udp_packet and 'type' in udp_packet:
+                try:
+                    wanted = (udp_packet['serial_number'].replace("-","_"), udp_packet['type']) in sources
+                except (AttributeError, TypeError):
+                    # serial_number or type is valid JSON, but not a string
+                    loginf('Corrupt UDP packet? %s' % udp_packet)
+                    continue
+                if not wanted:
+                    continue
+            m3 = build(parse(udp_packet, names, key_cache), rev_map, map_items)
+            if m3 is not None:
                 yield m3
 
     def gen_udp_packets(self):
@@ -303,23 +448,50 @@ class WeatherFlowUDPDriver(weewx.drivers.AbstractDevice):
             if self._share_socket:
                 sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
             sock.bind((self._udp_address,self._udp_port))
-            sock.settimeout(self._udp_timeout)
+            if self._udp_rcvbuf > 0:
+                # A deeper kernel queue rides out bursts while we are busy elsewhere. The kernel
+                # may quietly cap the request (net.core.rmem_max on Linux), so log what we got.
+                try:
+                    sock.setsockopt(SOL_SOCKET, SO_RCVBUF, self._udp_rcvbuf)
+                except error as e:
+                    loginf('Unable to set UDP receive buffer to %s: %s' % (self._udp_rcvbuf, e))
+                loginf('UDP receive buffer: requested %s bytes, kernel reports %s bytes%s'
+                       % (self._udp_rcvbuf, sock.getsockopt(SOL_SOCKET, SO_RCVBUF),
+                          ' (Linux reports double the usable size)' if sys.platform.startswith('linux') else ''))
+            sock.setblocking(0)
+
+            # Receive every datagram into the same buffer, rather than allocating a new one each time.
+            # Tempest obs_st packets can run past 1024 bytes with every field present.
+            buf = bytearray(2048)
+            view = memoryview(buf)
 
             while True:
-                try:
-                    m0, host_info = sock.recvfrom(1024)
-                except timeout:
+                ready, _, _ = select.select([sock], [], [], self._udp_timeout)
+                if not ready:
                     logerr('Socket timeout waiting for incoming UDP packet!')
+                    continue
+                try:
+                    nbytes, host_info = sock.recvfrom_into(buf)
+                except error as e:
+                    # select() can flag a datagram that the kernel then throws away (bad checksum,
+                    # or another process on a shared socket got to it first).
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
                 else:
                     # Decode the JSON. Some base stations have emitted datagrams that are not pure UTF-8, so
-                    # be prepared to catch the exception.
+                    # be prepared to catch the exception. orjson reports bad UTF-8 as a JSONDecodeError,
+                    # which is a subclass of ValueError.
                     try:
-                        m1 = json.loads(m0)
-                    except UnicodeDecodeError:
-                        loginf("Unable to decode packet %s" % m0)
+                        m1 = _loads_buffer(view[:nbytes])
+                    except (UnicodeDecodeError, ValueError) as e:
+                        loginf("Unable to decode packet %r: %s" % (view[:nbytes].tobytes(), e))
                     else:
+                        if not isinstance(m1, dict):
+                            # Valid JSON, but not a WeatherFlow packet
+                            loginf("Unable to decode packet %r: not a JSON object" % view[:nbytes].tobytes())
+                            continue
                         if self._log_raw_packets:
-                            loginf('raw packet: %s' % m1)
+                            lograw(m1)
                         yield m1
         finally:
             sock.close()